@@ -13,6 +13,10 @@ from string import Formatter
 from functools import partial
 import collections
 import traceback
+import time
+import fcntl
+import itertools
+from distutils.spawn import find_executable
 try:
     import yaml
 except ImportError:
@@ -32,19 +36,512 @@ def attribute_dict(orig):
             d[k] = attribute_dict(v)
     return AttributeDict(d)
 
+def replace_file(path, contents):
+    # swaps the new contents in atomically so readers never see a partial file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(contents)
+    os.rename(tmp, path)
+
+def locked_update(path, update):
+    # rewrites path with update(old contents or None) under an exclusive lock
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                old = f.read()
+        except IOError:
+            old = None
+        replace_file(path, update(old))
+
 def map_or_single(fn, list_or_single):
     if isinstance(list_or_single, list):
         return map(fn, list_or_single)
     else:
         return fn(list_or_single)
 
+class Metrics:
+    # (name, type, help); every sample is additive, so merging with the
+    # existing textfile is a per-sample sum. Each invocation only appends its
+    # samples to <path>.journal; the journal is folded into the textfile at
+    # most every `interval` seconds by whichever invocation gets there first.
+    FAMILIES = [
+        ('clictl_invocations_total', 'counter', 'Number of clictl invocations by outcome.'),
+        ('clictl_rule_hits_total', 'counter', 'Number of times a require rule was evaluated.'),
+        ('clictl_requirement_not_met_total', 'counter', 'Number of times a require rule denied the command.'),
+        ('clictl_cache_hits_total', 'counter', 'Number of wrapped commands replayed from the result cache.'),
+        ('clictl_cache_misses_total', 'counter', 'Number of cacheable wrapped commands that had to be run.'),
+        ('clictl_cache_bytes_saved_total', 'counter', 'Bytes of output replayed from the result cache.'),
+        ('clictl_evaluation_seconds', 'histogram', 'Time spent evaluating the before and pipeline steps.'),
+        ('clictl_child_seconds', 'histogram', 'Runtime of the wrapped command.'),
+    ]
+    BUCKETS = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300]
+    SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = collections.defaultdict(float)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k,v in labels) + '}'
+
+    def inc(self, name, labels = None, value = 1):
+        self.samples[(name, Metrics.format_labels(labels))] += value
+
+    def observe(self, name, seconds, labels = None):
+        labels = list(labels or [])
+        for le in Metrics.BUCKETS:
+            self.inc(name + '_bucket', labels + [('le', '{:g}'.format(le))], 1 if seconds <= le else 0)
+        self.inc(name + '_bucket', labels + [('le', '+Inf')])
+        self.inc(name + '_sum', labels, seconds)
+        self.inc(name + '_count', labels)
+
+    @staticmethod
+    def merge(text, samples):
+        for line in (text or '').splitlines():
+            m = Metrics.SAMPLE.match(line)
+            if m:
+                samples[(m.group(1), m.group(2) or '')] += float(m.group(3))
+        return samples
+
+    @staticmethod
+    def sort_key(sample):
+        (name, labels), _ = sample
+        le = re.search(r'[{,]le="([^"]*)"}$', labels)
+        suffix = ['_bucket', '_sum', '_count'].index(name[name.rindex('_'):]) if name.endswith(('_bucket', '_sum', '_count')) else 0
+        return (labels[:le.start()] if le else labels, suffix, float(le.group(1)) if le else 0)
+
+    @staticmethod
+    def to_text(samples):
+        lines = []
+        for family, type_name, help in Metrics.FAMILIES:
+            lines.append('# HELP {} {}'.format(family, help))
+            lines.append('# TYPE {} {}'.format(family, type_name))
+            names = {family} if type_name == 'counter' else {family + '_bucket', family + '_sum', family + '_count'}
+            for (name, labels), value in sorted([s for s in samples.items() if s[0][0] in names], key = Metrics.sort_key):
+                lines.append('{}{} {}'.format(name, labels, repr(value) if value != int(value) else int(value)))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self, path):
+        if self.samples:
+            with open(path + '.lock', 'a') as lock:
+                # shared: appends may interleave, but not with a compaction
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                with open(path + '.journal', 'a') as f:
+                    f.write(json.dumps(self.samples.items()) + '\n')
+            self.samples.clear()
+        try:
+            due = time.time() - os.stat(path).st_mtime >= self.interval
+        except OSError:
+            due = True
+        if due:
+            Metrics.compact(path)
+
+    @staticmethod
+    def compact(path):
+        with open(path + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            try:
+                with open(path + '.journal') as f:
+                    journal = f.read()
+            except IOError:
+                journal = ''
+            try:
+                with open(path) as f:
+                    old = f.read()
+            except IOError:
+                old = None
+            samples = collections.defaultdict(float)
+            for line in journal.splitlines():
+                for (name, labels), value in json.loads(line):
+                    samples[(name.encode('utf-8'), labels.encode('utf-8'))] += value
+            replace_file(path, Metrics.to_text(Metrics.merge(old, samples)))
+            if journal:
+                os.remove(path + '.journal')
+
+class Profile:
+    # per-node evaluation counts, passing outcomes and total seconds, keyed by
+    # the node's profile_key (its to_string() in the original config order)
+    def __init__(self):
+        self.nodes = {}
+
+    def record(self, node, outcome, seconds):
+        key = getattr(node, 'profile_key', None) or node.to_string()
+        entry = self.nodes.setdefault(key, {'count': 0, 'true': 0, 'seconds': 0.0})
+        entry['count'] += 1
+        entry['true'] += 1 if outcome else 0
+        entry['seconds'] += seconds
+
+    def merge(self, text):
+        nodes = json.loads(text) if text else {}
+        for key, entry in self.nodes.iteritems():
+            merged = nodes.setdefault(key, {'count': 0, 'true': 0, 'seconds': 0.0})
+            for k in entry:
+                merged[k] += entry[k]
+        return json.dumps(nodes, indent = 1, sort_keys = True, separators = (',', ': '))
+
+    def flush(self, path):
+        locked_update(path, self.merge)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+class Facts:
+    # facts read in-process instead of through shell steps; each is resolved on
+    # first use and memoized for the invocation. Facts derived from files that
+    # are costly to parse are also cached across invocations keyed on mtime.
+    class Namespace:
+        # underscored so that facts such as host.name are not shadowed
+        def __init__(self, facts, namespace):
+            self._facts = facts
+            self._namespace = namespace
+        def __getattr__(self, key):
+            return self._facts.get(self._namespace, key)
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.cache = None
+        self.updates = {}
+        self.values = {}
+
+    def __getattr__(self, name):
+        if name not in Facts.PROVIDERS:
+            raise AttributeError('unknown fact namespace "{}"'.format(name))
+        return Facts.Namespace(self, name)
+
+    def get(self, namespace, key):
+        if (namespace, key) not in self.values:
+            provider = Facts.PROVIDERS[namespace].get(key)
+            if provider is None:
+                raise AttributeError('unknown fact "{}.{}"'.format(namespace, key))
+            self.values[(namespace, key)] = provider(self)
+        return self.values[(namespace, key)]
+
+    def cached(self, key, path, compute):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return compute(None)
+        if self.cache is None:
+            try:
+                with open(self.cache_path) as f:
+                    self.cache = json.load(f)
+            except (IOError, ValueError):
+                self.cache = {}
+        entry = self.cache.get(key)
+        if entry and entry['path'] == path and entry['mtime'] == mtime:
+            return entry['value']
+        value = compute(path)
+        self.cache[key] = self.updates[key] = {'path': path, 'mtime': mtime, 'value': value}
+        return value
+
+    def merge(self, text):
+        try:
+            cache = json.loads(text) if text else {}
+        except ValueError:
+            cache = {}
+        cache.update(self.updates)
+        return json.dumps(cache)
+
+    def flush(self):
+        if self.updates:
+            if not os.path.isdir(os.path.dirname(self.cache_path)):
+                os.makedirs(os.path.dirname(self.cache_path))
+            locked_update(self.cache_path, self.merge)
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def git_dir(self):
+        if ('git', 'dir') not in self.values:
+            self.values[('git', 'dir')] = (None, None)
+            d = os.getcwd()
+            while True:
+                dotgit = os.path.join(d, '.git')
+                if os.path.isdir(dotgit):
+                    self.values[('git', 'dir')] = (d, dotgit)
+                    break
+                elif os.path.isfile(dotgit):
+                    gitdir = (Facts.read(dotgit) or '').replace('gitdir:', '', 1).strip()
+                    self.values[('git', 'dir')] = (d, os.path.join(d, gitdir))
+                    break
+                elif os.path.dirname(d) == d:
+                    break
+                d = os.path.dirname(d)
+        return self.values[('git', 'dir')]
+
+    # .git/HEAD and refs are tiny, reading them directly beats the cache
+    def git_head(self):
+        _, gitdir = self.git_dir()
+        return Facts.read(os.path.join(gitdir, 'HEAD')) if gitdir else None
+
+    def git_branch(self):
+        head = self.git_head() or ''
+        return head[len('ref: refs/heads/'):] if head.startswith('ref: refs/heads/') else ''
+
+    def git_commit(self):
+        head = self.git_head() or ''
+        if not head.startswith('ref: '):
+            return head
+        ref = head[len('ref: '):]
+        _, gitdir = self.git_dir()
+        commondir = os.path.join(gitdir, Facts.read(os.path.join(gitdir, 'commondir')) or '.')
+        commit = Facts.read(os.path.join(commondir, ref))
+        if commit:
+            return commit
+        for line in (Facts.read(os.path.join(commondir, 'packed-refs')) or '').splitlines():
+            if line.endswith(' ' + ref):
+                return line.split(' ')[0]
+        return ''
+
+    def kube_config(self):
+        # merged first-wins across KUBECONFIG like kubectl: the first file that
+        # sets current-context picks it, the first file defining it describes it
+        def compute(path):
+            with open(path) as f:
+                config = yaml.safe_load(f) or {}
+            namespaces = dict((c.get('name'), (c.get('context') or {}).get('namespace') or '') for c in config.get('contexts') or [])
+            return {'current-context': config.get('current-context') or '', 'namespaces': namespaces}
+        paths = os.environ.get('KUBECONFIG') or os.path.expanduser('~/.kube/config')
+        files = [self.cached('kubeconfig:' + path, path, lambda p: compute(p) if p else None) for path in paths.split(os.pathsep) if path]
+        files = [f for f in files if f]
+        context = next((f['current-context'] for f in files if f['current-context']), '')
+        if not context:
+            return {'context': '', 'namespace': ''}
+        namespace = next((f['namespaces'][context] for f in files if context in f['namespaces']), '')
+        return {'context': context, 'namespace': namespace or 'default'}
+
+    # imported on use, most invocations never ask for these
+    def host_name(self):
+        import socket
+        return socket.gethostname()
+
+    def user_name(self):
+        import getpass
+        return getpass.getuser()
+
+Facts.PROVIDERS = {
+    'git': {
+        'branch': Facts.git_branch,
+        'commit': Facts.git_commit,
+        'root': lambda facts: facts.git_dir()[0] or '',
+    },
+    'kube': {
+        'context': lambda facts: facts.kube_config()['context'],
+        'namespace': lambda facts: facts.kube_config()['namespace'],
+    },
+    'host': {
+        'name': Facts.host_name,
+    },
+    'user': {
+        'name': Facts.user_name,
+    },
+}
+
+class Limiter:
+    # named counting semaphores shared by all processes on the host: slot i of
+    # name is held by whoever has an flock on <directory>/<name>.<i>.lock. The
+    # kernel drops the lock when its holder dies, so stale slots free themselves.
+    class Timeout(Exception):
+        pass
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def lock_dir(self):
+        if self.directory is None:
+            import tempfile
+            self.directory = os.path.join(tempfile.gettempdir(), 'clictl-{}'.format(os.getuid()))
+        return self.directory
+
+    def try_acquire(self, name, slots):
+        for i in range(slots):
+            path = os.path.join(self.lock_dir(), '{}.{}.lock'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', name), i))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                continue
+            # keep the slot out of the wrapped command so it is freed with us
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()))
+            return fd
+        return None
+
+    def acquire(self, name, slots, timeout):
+        if not os.path.isdir(self.lock_dir()):
+            try:
+                os.makedirs(self.lock_dir())
+            except OSError:
+                if not os.path.isdir(self.lock_dir()):
+                    raise
+        deadline = time.time() + timeout if timeout is not None else None
+        delay = 0.01
+        while True:
+            fd = self.try_acquire(name, slots)
+            if fd is not None:
+                return fd
+            if deadline is not None and time.time() >= deadline:
+                raise Limiter.Timeout('timed out after {}s waiting for limit "{}"'.format(timeout, name))
+            time.sleep(max(0, min(delay, deadline - time.time())) if deadline is not None else delay)
+            delay = min(delay * 2, 0.5)
+
+    def acquire_all(self, limits):
+        # one slot per name is enough for this process, and taking a second
+        # would wait on itself; keep the strictest max and shortest timeout
+        merged = {}
+        for name, slots, timeout in limits:
+            if name in merged:
+                other_slots, other_timeout = merged[name]
+                slots = min(slots, other_slots)
+                timeout = other_timeout if timeout is None else timeout if other_timeout is None else min(timeout, other_timeout)
+            merged[name] = (slots, timeout)
+        # a fixed order keeps processes that need several limits from deadlocking
+        held = []
+        try:
+            for name in sorted(merged):
+                held.append(self.acquire(name, *merged[name]))
+        except:
+            Limiter.release(held)
+            raise
+        return held
+
+    @staticmethod
+    def release(held):
+        for fd in held:
+            os.close(fd)
+
+class ResultCache:
+    # output and exit code of idempotent commands, one file per entry, plus an
+    # index of sizes, last use and hit statistics used for LRU eviction
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(cmds, spec):
+        import hashlib
+        env = [(name, os.environ.get(name)) for name in spec['env']]
+        files = []
+        for path in spec['files']:
+            try:
+                files.append((path, os.stat(path).st_mtime))
+            except OSError:
+                files.append((path, None))
+        # repr rather than json: argv and environment values need not be utf-8
+        return hashlib.sha1(repr([cmds, env, files])).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key, ttl):
+        import base64
+        try:
+            with open(self.entry_path(key)) as f:
+                entry = json.load(f)
+            if time.time() - entry['created'] > ttl:
+                return None
+            return entry['code'], base64.b64decode(entry['stdout']), base64.b64decode(entry['stderr'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, key, code, stdout, stderr):
+        import base64
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp = '{}.{}.tmp'.format(self.entry_path(key), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'created': time.time(), 'code': code, 'stdout': base64.b64encode(stdout), 'stderr': base64.b64encode(stderr)}, f)
+        os.rename(tmp, self.entry_path(key))
+        self.update_index(key, False, 0, len(stdout) + len(stderr))
+
+    def hit(self, key, saved):
+        self.update_index(key, True, saved, None)
+
+    def miss(self):
+        self.update_index(None, False, 0, None)
+
+    def update_index(self, key, hit, saved, size):
+        def update(text):
+            try:
+                index = json.loads(text) if text else None
+            except ValueError:
+                index = None
+            index = index or {'entries': {}, 'stats': {'hits': 0, 'misses': 0, 'bytes_saved': 0}}
+            entries = index['entries']
+            if key is not None:
+                entries.setdefault(key, {'size': 0})['used'] = time.time()
+            if size is not None:
+                entries[key]['size'] = size
+            elif key is None:
+                index['stats']['misses'] += 1
+            if hit:
+                index['stats']['hits'] += 1
+                index['stats']['bytes_saved'] += saved
+            total = sum(e['size'] for e in entries.itervalues())
+            for k, e in sorted(entries.items(), key = lambda x: x[1]['used']):
+                if total <= self.max_bytes:
+                    break
+                total -= e['size']
+                del entries[k]
+                try:
+                    os.remove(self.entry_path(k))
+                except OSError:
+                    pass
+            return json.dumps(index)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        locked_update(os.path.join(self.directory, 'index.json'), update)
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.directory, 'index.json')) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {'entries': {}, 'stats': {'hits': 0, 'misses': 0, 'bytes_saved': 0}}
+        stats = dict(index['stats'])
+        stats['entries'] = len(index['entries'])
+        stats['bytes'] = sum(e['size'] for e in index['entries'].itervalues())
+        return stats
+
 class Context:
-    def __init__(self, cmds, vars, verbose):
+    def __init__(self, cmds, vars, verbose, metrics = None, profile = None):
         self.cmds = cmds
         self.vars = attribute_dict(vars)
         self.verbose = verbose
+        self.metrics = metrics
+        self.profile = profile
+        self.limits = []
+        self.cache = None
         self.formatter = Formatter()
 
+    def execute(self, node):
+        if self.profile is None:
+            return node.execute(self)
+        started = time.time()
+        outcome = False
+        try:
+            outcome = node.execute(self)
+            return outcome
+        finally:
+            self.profile.record(node, outcome, time.time() - started)
+
     def eval(self, path):
         if isinstance(path, basestring):
             return self.formatter.vformat(path, self.cmds, self.vars)
@@ -118,7 +615,7 @@ class Ast:
             ctx.verbose_log(self)
             return re.search(self.pattern, ctx.eval(self.expr)) is not None
         def to_string(self):
-            return '{} match /{}/'.format(ctx.to_string(self.expr), ctx.to_string(self.pattern))
+            return '{} match /{}/'.format(Context.to_string(self.expr), Context.to_string(self.pattern))
 
     class Equal:
         def __init__(self, items):
@@ -143,7 +640,7 @@ class Ast:
             self.items = items
         def execute(self, ctx):
             ctx.verbose_log(self)
-            return reduce(lambda l,r: l and r, map(lambda x: x.execute(ctx), self.items))
+            return all(ctx.execute(x) for x in self.items)
         def to_string(self):
             return '({})'.format(' and '.join(map(Context.to_string, self.items)))
 
@@ -152,9 +649,101 @@ class Ast:
             self.items = items
         def execute(self, ctx):
             ctx.verbose_log(self)
-            return reduce(lambda l,r: l or r, map(lambda x: x.execute(ctx), self.items))
+            return any(ctx.execute(x) for x in self.items)
         def to_string(self):
-            return '({})'.format(' and '.join(map(Context.to_string, self.items)))
+            return '({})'.format(' or '.join(map(Context.to_string, self.items)))
+
+    class ItemTest:
+        # a pattern or comparison applied to each item of a list variable,
+        # by default the wrapped command's arguments without the command itself
+        def __init__(self, kind, value, source):
+            self.kind = kind
+            self.value = value
+            self.source = source
+        def items(self, ctx):
+            if self.source is None:
+                return ctx.cmds[1:]
+            items = ctx.formatter.get_field(self.source, ctx.cmds, ctx.vars)[0]
+            return [items] if isinstance(items, basestring) else items
+        def matcher(self, ctx):
+            if self.kind == 'match':
+                search = self.value.search
+                return lambda x: search(x) is not None
+            value = ctx.eval(self.value)
+            if self.kind == 'equal':
+                return lambda x: x == value
+            else:
+                return lambda x: x != value
+        def to_string(self):
+            source = '{' + self.source + '}' if self.source is not None else '{1..}'
+            if self.kind == 'match':
+                return '{} match /{}/'.format(source, self.value.pattern)
+            return '{} {} {}'.format(source, '==' if self.kind == 'equal' else '!=', self.value)
+
+    class Any:
+        def __init__(self, test):
+            self.test = test
+        def execute(self, ctx):
+            ctx.verbose_log(self)
+            return any(itertools.imap(self.test.matcher(ctx), self.test.items(ctx)))
+        def to_string(self):
+            return 'any ({})'.format(self.test.to_string())
+
+    class All:
+        def __init__(self, test):
+            self.test = test
+        def execute(self, ctx):
+            ctx.verbose_log(self)
+            return all(itertools.imap(self.test.matcher(ctx), self.test.items(ctx)))
+        def to_string(self):
+            return 'all ({})'.format(self.test.to_string())
+
+    class Count:
+        def __init__(self, test, min, max):
+            self.test = test
+            self.min = min
+            self.max = max
+        def execute(self, ctx):
+            ctx.verbose_log(self)
+            count = 0
+            for matched in itertools.imap(self.test.matcher(ctx), self.test.items(ctx)):
+                if matched:
+                    count += 1
+                    if self.max is not None and count > self.max:
+                        return False
+                    if self.max is None and count >= self.min:
+                        return True
+            return count >= self.min
+        def to_string(self):
+            return 'count ({}) in [{}, {}]'.format(self.test.to_string(), self.min, self.max if self.max is not None else '')
+
+    class Limit:
+        def __init__(self, name, max, timeout):
+            self.name = name
+            self.max = max
+            self.timeout = timeout
+        def execute(self, ctx):
+            ctx.verbose_log(self)
+            ctx.limits.append((ctx.eval(self.name), self.max, self.timeout))
+        def to_string(self):
+            return 'limit ({} <= {})'.format(self.name, self.max)
+
+    class Cache:
+        def __init__(self, ttl, env, files, codes):
+            self.ttl = ttl
+            self.env = env
+            self.files = files
+            self.codes = codes
+        def execute(self, ctx):
+            ctx.verbose_log(self)
+            ctx.cache = {
+                'ttl': self.ttl,
+                'env': self.env,
+                'files': [os.path.expanduser(ctx.eval(f)) for f in self.files],
+                'codes': self.codes
+            }
+        def to_string(self):
+            return 'cache ({}s)'.format(self.ttl)
 
     class RequirementNotMet(Exception):
         pass
@@ -163,7 +752,11 @@ class Ast:
             self.predicate = predicate
         def execute(self, ctx):
             ctx.verbose_log(self)
+            if ctx.metrics:
+                ctx.metrics.inc('clictl_rule_hits_total', [('rule', self.to_string())])
             if not self.predicate.execute(ctx):
+                if ctx.metrics:
+                    ctx.metrics.inc('clictl_requirement_not_met_total', [('rule', self.to_string())])
                 raise Ast.RequirementNotMet(self.to_string())
             return ctx
         def to_string(self):
@@ -181,7 +774,7 @@ class Ast:
             else:
                 return map_or_single(lambda x: ctx.eval(x), self.elses) if self.elses is not None else None
         def to_string(self):
-            return 'if ({}) then ({}) else ({})'.format(self.condition.to_string(), [t.to_string() for t in self.thens], [t.to_string() for t in self.elses])
+            return 'if ({}) then ({}) else ({})'.format(Context.to_string(self.condition), map_or_single(Context.to_string, self.thens), map_or_single(Context.to_string, self.elses))
 
 class AstParser:
     class ParseException(Exception):
@@ -219,9 +812,42 @@ class AstParser:
             return Ast.Equal(definition)
         elif type_name in {'neq', '!='}:
             return Ast.Not(Ast.Equal(definition))
+        elif type_name == 'any':
+            return Ast.Any(AstParser.parse_item_test(definition))
+        elif type_name == 'all':
+            return Ast.All(AstParser.parse_item_test(definition))
+        elif type_name == 'count':
+            return AstParser.parse_count(definition)
         else:
             raise AstParser.ParseException('unknown predicate of type "{}"'.format(type_name))
 
+    @staticmethod
+    def parse_count(json):
+        test = AstParser.parse_item_test(json)
+        min, max = json.get('min', 0), json.get('max')
+        for name, bound in [('min', min), ('max', max)]:
+            if bound is not None and (not isinstance(bound, int) or isinstance(bound, bool)):
+                raise AstParser.ParseException('count {} must be an integer, found "{}"'.format(name, bound))
+        if min is None or (max is not None and min > max):
+            raise AstParser.ParseException('count needs min <= max, found [{}, {}]'.format(min, max))
+        return Ast.Count(test, min, max)
+
+    @staticmethod
+    def parse_item_test(json):
+        if not isinstance(json, collections.Mapping):
+            raise AstParser.ParseException('expected a mapping with one of match, equal or neq, found "{}"'.format(json))
+        source = json.get('in')
+        if 'match' in json:
+            try:
+                return Ast.ItemTest('match', re.compile(json['match']), source)
+            except re.error as e:
+                raise AstParser.ParseException('invalid pattern "{}": {}'.format(json['match'], e))
+        for kind, names in [('equal', ['equal', 'eq', '==']), ('neq', ['neq', '!='])]:
+            for name in names:
+                if name in json:
+                    return Ast.ItemTest(kind, json[name], source)
+        raise AstParser.ParseException('expected one of match, equal or neq in {}'.format(json))
+
     @staticmethod
     def parse_if(json):
         t = AstParser.parse_tuple(json, ['condition', 'then', 'else'])
@@ -260,9 +886,239 @@ class AstParser:
             return Ast.ShellExec(json.values()[0])
         elif type_name in {'assign', ':='}:
             return Ast.Assign(definition.keys()[0], AstParser.parse_or_str(definition.values()[0], lambda j: AstParser.parse_pipeline_item(j)))
+        elif type_name == 'limit':
+            return AstParser.parse_limit(definition)
+        elif type_name == 'cache':
+            return AstParser.parse_cache(definition)
         else:
             raise AstParser.ParseException('unknown pipeline step "{}"'.format(type_name))
 
+    @staticmethod
+    def parse_limit(json):
+        t = AstParser.parse_tuple(json, ['name', 'max', 'timeout'])
+        if 'name' not in t or not isinstance(t.get('max', 1), int) or t.get('max', 1) < 1:
+            raise AstParser.ParseException('limit needs a name and a max of at least 1')
+        timeout = t.get('timeout')
+        if timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout < 0):
+            raise AstParser.ParseException('limit timeout must be a number of seconds, found "{}"'.format(timeout))
+        return Ast.Limit(t['name'], t.get('max', 1), t.get('timeout'))
+
+    @staticmethod
+    def parse_cache(json):
+        t = json if isinstance(json, collections.Mapping) else {'ttl': json}
+        if not isinstance(t.get('ttl'), (int, float)):
+            raise AstParser.ParseException('cache needs a ttl in seconds')
+        listed = lambda v: v if isinstance(v, list) else [v]
+        return Ast.Cache(t['ttl'], listed(t.get('env', [])), listed(t.get('files', [])), listed(t.get('codes', [0])))
+
+class ArgvSchema:
+    # flags: {name: arity | {arity, aliases}}, subcommands: {name: schema};
+    # the long form --name is always accepted
+    def __init__(self, flags, subcommands):
+        self.flags = flags
+        self.subcommands = subcommands
+        self.lookup = {}
+        for name, (arity, aliases) in flags.iteritems():
+            for alias in ['--' + name] + aliases:
+                self.lookup[alias] = (name, arity)
+
+    @staticmethod
+    def parse(json):
+        if not isinstance(json, collections.Mapping):
+            raise AstParser.ParseException('schema must be a mapping')
+        if not isinstance(json.get('flags') or {}, collections.Mapping):
+            raise AstParser.ParseException('schema flags must be a mapping')
+        flags = {}
+        for name, spec in (json.get('flags') or {}).iteritems():
+            if isinstance(spec, int) and not isinstance(spec, bool):
+                spec = {'arity': spec}
+            elif spec is None:
+                spec = {}
+            elif not isinstance(spec, collections.Mapping):
+                raise AstParser.ParseException('flag "{}" must be an arity or a mapping of arity and aliases, found "{}"'.format(name, spec))
+            arity = spec.get('arity', 0)
+            if not isinstance(arity, int) or isinstance(arity, bool) or arity < 0:
+                raise AstParser.ParseException('flag "{}" has an invalid arity "{}"'.format(name, arity))
+            aliases = spec.get('aliases', [])
+            flags[name] = (arity, aliases if isinstance(aliases, list) else [aliases])
+        subcommands = dict((k, ArgvSchema.parse(v or {})) for k,v in (json.get('subcommands') or {}).iteritems())
+        return ArgvSchema(flags, subcommands)
+
+    @staticmethod
+    def default(arity):
+        return False if arity == 0 else '' if arity == 1 else []
+
+    def parse_argv(self, argv):
+        schema = self
+        lookup = dict(self.lookup)
+        flags = dict((name, ArgvSchema.default(arity)) for name, (arity, _) in self.flags.iteritems())
+        positionals = []
+        subcommand = []
+        argv = list(argv)
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            i += 1
+            if arg == '--':
+                positionals += argv[i:]
+                break
+            elif arg.startswith('--'):
+                name, eq, value = arg.partition('=')
+                value = value if eq else None
+            elif arg.startswith('-') and len(arg) > 1:
+                name, value = arg[:2], arg[2:] or None
+            elif not positionals and arg in schema.subcommands:
+                schema = schema.subcommands[arg]
+                subcommand.append(arg)
+                lookup.update(schema.lookup)
+                for name, (arity, _) in schema.flags.iteritems():
+                    flags.setdefault(name, ArgvSchema.default(arity))
+                continue
+            else:
+                positionals.append(arg)
+                continue
+
+            if name not in lookup:
+                flags[name.lstrip('-')] = value if value is not None else True
+                continue
+            name, arity = lookup[name]
+            if arity == 0:
+                flags[name] = True
+                if value is not None and not arg.startswith('--'):
+                    # clustered short flags: -Av
+                    argv.insert(i, '-' + value)
+                continue
+            values = [value] if value is not None else []
+            while len(values) < arity and i < len(argv):
+                values.append(argv[i])
+                i += 1
+            if arity == 1:
+                flags[name] = values[0] if values else ArgvSchema.default(arity)
+            else:
+                flags[name] = values
+        return {
+            "flags": flags,
+            "positionals": positionals,
+            "subcommand": ' '.join(subcommand)
+        }
+
+class AstOptimizer:
+    @staticmethod
+    def children(node):
+        if isinstance(node, (Ast.And, Ast.Or)):
+            children = node.items
+        elif isinstance(node, Ast.Not):
+            children = [node.inner]
+        elif isinstance(node, Ast.Require):
+            children = [node.predicate]
+        elif isinstance(node, Ast.If):
+            children = [node.condition] + [x for b in [node.thens, node.elses] if b is not None for x in (b if isinstance(b, list) else [b])]
+        elif isinstance(node, Ast.Match):
+            children = [node.expr]
+        elif isinstance(node, Ast.Echo):
+            children = [node.msg]
+        elif isinstance(node, Ast.Assign):
+            children = [node.value]
+        else:
+            children = []
+        return [c for c in children if not isinstance(c, basestring)]
+
+    @staticmethod
+    def label(node):
+        # keys are taken before any reordering so profiles recorded with and
+        # without --reorder-from accumulate on the same entries
+        node.profile_key = node.to_string()
+        for c in AstOptimizer.children(node):
+            AstOptimizer.label(c)
+
+    @staticmethod
+    def safe_fields(schema):
+        # interpolations that always resolve: facts have a provider for every
+        # declared key, and the schema fills in defaults for its top-level
+        # flags. {1}, {env.x} and {usr.x} may be missing when the rule runs.
+        fields = {'args', 'config.force'}
+        fields.update('facts.{}.{}'.format(n, k) for n, keys in Facts.PROVIDERS.iteritems() for k in keys)
+        if schema:
+            fields.update(['positionals', 'subcommand'])
+            fields.update(f.format(name) for name in schema.flags for f in ['flags.{}', 'flags[{}]'])
+        return fields
+
+    @staticmethod
+    def is_safe(value, fields):
+        try:
+            return isinstance(value, basestring) and all(field is None or (field in fields and not spec and conversion in (None, 'r', 's'))
+                for _, field, spec, conversion in Formatter().parse(value))
+        except ValueError:
+            return False
+
+    @staticmethod
+    def is_pure(node, fields):
+        # side effect free and unable to raise: an interpolation that can fail
+        # must stay put, moving it changes whether the error is reached
+        if isinstance(node, (Ast.True, Ast.False)):
+            return True
+        elif isinstance(node, Ast.Equal):
+            return all(AstOptimizer.is_safe(x, fields) for x in node.items)
+        elif isinstance(node, Ast.Match):
+            return AstOptimizer.is_safe(node.expr, fields)
+        elif isinstance(node, (Ast.Any, Ast.All, Ast.Count)):
+            return (node.test.source is None or node.test.source in fields) and (node.test.kind == 'match' or AstOptimizer.is_safe(node.test.value, fields))
+        elif isinstance(node, (Ast.Not, Ast.And, Ast.Or, Ast.Require)):
+            return all(AstOptimizer.is_pure(c, fields) for c in AstOptimizer.children(node))
+        else:
+            return False
+
+    @staticmethod
+    def rank(stats, node, decisive):
+        # expected cost per decisive outcome; cheap checks that usually
+        # settle the result sort first
+        entry = stats.get(node.profile_key)
+        if not entry or not entry['count']:
+            return None
+        hits = entry['true'] if decisive else entry['count'] - entry['true']
+        return entry['seconds'] / hits if hits else float('inf')
+
+    @staticmethod
+    def sort(stats, fields, nodes, decisive):
+        ranks = [AstOptimizer.rank(stats, n, decisive) for n in nodes]
+        if None in ranks or not all(AstOptimizer.is_pure(n, fields) for n in nodes):
+            return nodes
+        return [n for _, n in sorted(zip(ranks, nodes), key = lambda x: x[0])]
+
+    @staticmethod
+    def reorder(stats, fields, node):
+        for c in AstOptimizer.children(node):
+            AstOptimizer.reorder(stats, fields, c)
+        if isinstance(node, Ast.And):
+            node.items = AstOptimizer.sort(stats, fields, node.items, False)
+        elif isinstance(node, Ast.Or):
+            node.items = AstOptimizer.sort(stats, fields, node.items, True)
+        elif isinstance(node, Ast.If):
+            node.thens = AstOptimizer.reorder_steps(stats, fields, node.thens) if isinstance(node.thens, list) else node.thens
+            node.elses = AstOptimizer.reorder_steps(stats, fields, node.elses) if isinstance(node.elses, list) else node.elses
+
+    @staticmethod
+    def reorder_steps(stats, fields, steps):
+        # only runs of adjacent side effect free requires commute; anything
+        # else in between keeps its position
+        reordered, run = [], []
+        for step in steps + [None]:
+            if isinstance(step, Ast.Require) and AstOptimizer.is_pure(step, fields):
+                run.append(step)
+                continue
+            reordered += AstOptimizer.sort(stats, fields, run, False)
+            run = []
+            if step is not None:
+                reordered.append(step)
+        return reordered
+
+    @staticmethod
+    def reorder_config(stats, config):
+        fields = AstOptimizer.safe_fields(config.schema)
+        for step in config.before + config.pipeline:
+            AstOptimizer.reorder(stats, fields, step)
+        return config._replace(before = AstOptimizer.reorder_steps(stats, fields, config.before), pipeline = AstOptimizer.reorder_steps(stats, fields, config.pipeline))
+
 parser = argparse.ArgumentParser()
 def parse_bool(name, v):
     if v == 'true' or v == 'True':
@@ -271,22 +1127,50 @@ def parse_bool(name, v):
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected for {}, found "{}"'.format(name, v))
+def parse_positive_int(name, v):
+    try:
+        n = int(v)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError('Positive integer expected for {}, found "{}"'.format(name, v))
+    return n
 config_group = parser.add_mutually_exclusive_group()
 config_group.add_argument('--config', required=False, default=None)
 config_group.add_argument('--config-file', required=False, default=None)
 parser.add_argument('--force', type=partial(parse_bool, 'force'), nargs='?', const=True, required=False, default=False)
 parser.add_argument('--verbose', type=partial(parse_bool, 'verbose'), nargs='?', const=True, required=False, default=False)
+parser.add_argument('--metrics-file', required=False, default=os.environ.get('CLICTL_METRICS_FILE'))
+parser.add_argument('--metrics-interval', type=float, required=False, default=10)
+parser.add_argument('--profile-file', required=False, default=None)
+parser.add_argument('--reorder-from', required=False, default=None)
+parser.add_argument('--fan-out', required=False, default=None)
+parser.add_argument('--jobs', type=partial(parse_positive_int, 'jobs'), required=False, default=None)
+parser.add_argument('--facts-cache', required=False, default=os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'clictl', 'facts.json'))
+
+parser.add_argument('--lock-dir', required=False, default=None)
+parser.add_argument('--cache-dir', required=False, default=os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'clictl', 'results'))
+parser.add_argument('--cache-size', type=int, required=False, default=64 * 1024 * 1024)
+parser.add_argument('--cache-stats', action='store_true', required=False, default=False)
+parser.add_argument('--no-collapse', type=partial(parse_bool, 'no-collapse'), nargs='?', const=True, required=False, default=False)
 
-clictl_args = sys.argv[1:]
-other_args = []
-if '--' in clictl_args:
-    other_args = clictl_args[clictl_args.index('--')+1:]
-    clictl_args = clictl_args[:clictl_args.index('--')]
+# options that apply to the whole process; nested clictl invocations are only
+# collapsed into this process when they agree on all of them
+PROCESS_OPTIONS = ['metrics_file', 'metrics_interval', 'profile_file', 'fan_out', 'jobs', 'facts_cache', 'lock_dir', 'cache_dir', 'cache_size', 'cache_stats']
+
+def split_args(argv):
+    clictl_args = argv
+    other_args = []
+    if '--' in clictl_args:
+        other_args = clictl_args[clictl_args.index('--')+1:]
+        clictl_args = clictl_args[:clictl_args.index('--')]
+    return clictl_args, other_args
+
+clictl_args, other_args = split_args(sys.argv[1:])
 args = parser.parse_args(clictl_args)
 cmds = other_args
 
-
-Config = namedtuple('Config', ['before', 'pipeline', 'after'])
+Config = namedtuple('Config', ['before', 'pipeline', 'after', 'detach_after', 'schema'])
 
 def parse_config(json):
 
@@ -302,68 +1186,377 @@ def parse_config(json):
         elif isinstance(json, list):
             pipeline = map(AstParser.parse_pipeline_item, json)
 
-    return Config(before = before or [], pipeline = pipeline or [], after = after or [])
+    detach_after = isinstance(json, collections.Mapping) and json.get('detach_after') is True
+    schema = ArgvSchema.parse(json['schema']) if isinstance(json, collections.Mapping) and 'schema' in json else None
 
-if args.config_file:
-    with open(args.config_file) as f:
-        config_json = yaml.load(f)
-        if config_json is None:
-            eprint('Invalid config file')
-            sys.exit(2)
-elif args.config:
-    config_json = yaml.load(args.config)
-    if config_json is None:
-        eprint('Invalid config')
-        sys.exit(2)
-else:
-    config_json = None
+    return Config(before = before or [], pipeline = pipeline or [], after = after or [], detach_after = detach_after, schema = schema)
 
-try:
-    if config_json is not None:
-        config = parse_config(config_json)
+def load_config(options):
+    # returns None after reporting the problem if the config is unusable
+    if options.config_file:
+        with open(options.config_file) as f:
+            config_json = yaml.load(f)
+            if config_json is None:
+                eprint('Invalid config file')
+                return None
+    elif options.config:
+        config_json = yaml.load(options.config)
+        if config_json is None:
+            eprint('Invalid config')
+            return None
     else:
-        config = Config([], [])
+        config_json = None
 
-except AstParser.ParseException as e:
-    if args.verbose:
-        traceback.print_exc()
-    eprint('Invalid configuration:', e.message)
+    try:
+        if config_json is not None:
+            config = parse_config(config_json)
+        else:
+            config = Config([], [], [], False, None)
+
+    except AstParser.ParseException as e:
+        if options.verbose:
+            traceback.print_exc()
+        eprint('Invalid configuration:', e.message)
+        return None
+
+    if options.profile_file or options.reorder_from:
+        for step in config.before + config.pipeline + config.after:
+            AstOptimizer.label(step)
+    if options.reorder_from:
+        try:
+            config = AstOptimizer.reorder_config(Profile.load(options.reorder_from), config)
+        except (IOError, ValueError) as e:
+            eprint('Could not read profile, keeping config order:', str(e))
+    return config
+
+config = load_config(args)
+if config is None:
     sys.exit(2)
 
-vars = {
-    "args": cmds,
-    "env": os.environ,
-    "usr": {},
-    "config": {
-        "force": args.force is True
-    }
-}
+metrics = Metrics(args.metrics_interval) if args.metrics_file else None
+profile = Profile() if args.profile_file else None
+facts = Facts(args.facts_cache)
+limiter = Limiter(args.lock_dir)
+cache = ResultCache(args.cache_dir, args.cache_size)
 
-ctx = Context(cmds, vars, 1 if args.verbose else 0)
+if args.cache_stats:
+    print(json.dumps(cache.stats(), sort_keys = True))
+    sys.exit(0)
 
-try:
-    for b in config.before:
-        b.execute(ctx)
+def exit_with(code):
+    if metrics:
+        try:
+            metrics.flush(args.metrics_file)
+        except (IOError, OSError, ValueError) as e:
+            eprint('Could not write metrics:', str(e))
+    if profile:
+        try:
+            profile.flush(args.profile_file)
+        except (IOError, OSError, ValueError) as e:
+            eprint('Could not write profile:', str(e))
+    try:
+        facts.flush()
+    except (IOError, OSError):
+        pass
+    sys.exit(code)
 
-    for p in config.pipeline:
-        p.execute(ctx)
+def make_context(cmds, options, config):
+    vars = {
+        "args": cmds,
+        "env": os.environ,
+        "usr": {},
+        "facts": facts,
+        "config": {
+            "force": options.force is True
+        }
+    }
+    if config.schema:
+        vars.update(config.schema.parse_argv(cmds[1:]))
+    ctx = Context(cmds, vars, 1 if options.verbose else 0, metrics, profile)
+    ctx.options = options
+    ctx.config = config
+    return ctx
+
+def evaluate(ctx):
+    # runs the before and pipeline steps, returning allowed, denied or error
+    try:
+        started = time.time()
+        try:
+            for b in ctx.config.before:
+                ctx.execute(b)
 
-    for b in config.after:
-        b.execute(ctx)
+            for p in ctx.config.pipeline:
+                ctx.execute(p)
+        finally:
+            if metrics:
+                metrics.observe('clictl_evaluation_seconds', time.time() - started)
+        result = 'allowed'
 
-except Ast.RequirementNotMet as e:
-    if args.verbose:
+    except Ast.RequirementNotMet as e:
+        if ctx.options.verbose:
+            traceback.print_exc()
+        eprint('Requirement not met:', e.message)
+        result = 'denied'
+    except Exception as e:
+        eprint('Error in pipeline:', str(e))
         traceback.print_exc()
-    eprint('Requirement not met:', e.message)
-    sys.exit(2)
-except Exception as e:
-    eprint('Error in pipeline:', str(e))
-    traceback.print_exc()
-    sys.exit(2)
+        result = 'error'
+
+    if metrics:
+        metrics.inc('clictl_invocations_total', [('result', result)])
+    return result
+
+def finish(ctx, exitCode, duration, spawned = True):
+    if metrics and spawned and len(ctx.cmds) > 0:
+        metrics.observe('clictl_child_seconds', duration)
+    ctx.vars['result'] = AttributeDict(code = exitCode, duration = duration)
+
+def run_after(contexts):
+    for ctx in contexts:
+        try:
+            for a in ctx.config.after:
+                a.execute(ctx)
+        except Ast.RequirementNotMet as e:
+            eprint('Requirement not met:', e.message)
+        except Exception as e:
+            eprint('Error in after:', str(e))
+            traceback.print_exc()
+
+def run_after_detached(contexts):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() != 0:
+        return
+    # the caller may be reading our stdout/stderr until EOF, so let go of them
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(devnull, fd)
+    # the parent flushes everything recorded so far; only report our own
+    if metrics:
+        metrics.samples.clear()
+    run_after(contexts)
+    if metrics:
+        try:
+            metrics.flush(args.metrics_file)
+        except (IOError, OSError, ValueError):
+            pass
+    os._exit(0)
+
+def after(contexts):
+    run_after([c for c in contexts if c.config.after and not c.config.detach_after])
+    detached = [c for c in contexts if c.config.after and c.config.detach_after]
+    if detached:
+        run_after_detached(detached)
+
+def run_captured(cmds, limits):
+    try:
+        held = limiter.acquire_all(limits)
+    except (Limiter.Timeout, IOError, OSError) as e:
+        return 2, '', 'Limit not acquired: {}\n'.format(e), 0
+    try:
+        started = time.time()
+        with open(os.devnull) as devnull:
+            p = subprocess.Popen(cmds, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+        return p.wait(), stdout, stderr, time.time() - started
+    finally:
+        Limiter.release(held)
+
+def run_teed(cmds):
+    # like the plain run, but keeps a copy of the output for the result cache
+    import threading
+    p = subprocess.Popen(cmds, stdin=sys.stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    outputs = ([], [])
+    def pump(source, stream, chunks):
+        for chunk in iter(lambda: os.read(source.fileno(), 65536), ''):
+            stream.write(chunk)
+            stream.flush()
+            chunks.append(chunk)
+    threads = [threading.Thread(target=pump, args=(p.stdout, sys.stdout, outputs[0])),
+               threading.Thread(target=pump, args=(p.stderr, sys.stderr, outputs[1]))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return p.wait(), ''.join(outputs[0]), ''.join(outputs[1])
+
+def write_labelled(stream, label, output):
+    for line in output.splitlines():
+        stream.write('[{}] {}\n'.format(label, line))
+    stream.flush()
+
+def fan_out(source):
+    # one policy evaluation per line of arguments, children on a bounded pool;
+    # output, including what the evaluation itself prints, is buffered per
+    # item and written labelled in input order. The imports are deferred so
+    # that plain invocations do not pay for them.
+    import shlex
+    from StringIO import StringIO
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    lines = [l.strip() for l in source if l.strip()]
+    contexts = []
+    results = []
+    outputs = []
+    for line in lines:
+        streams = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            try:
+                ctx = make_context(cmds + shlex.split(line), args, config)
+            except ValueError as e:
+                eprint('Invalid arguments:', str(e))
+                ctx, result = None, 'error'
+            else:
+                result = evaluate(ctx)
+            outputs.append((sys.stdout.getvalue(), sys.stderr.getvalue()))
+        finally:
+            sys.stdout, sys.stderr = streams
+        contexts.append(ctx)
+        results.append(result)
+    def run(item):
+        ctx, result = item
+        return run_captured(ctx.cmds, ctx.limits) if result == 'allowed' and len(ctx.cmds) > 0 else None
+    pool = ThreadPool(args.jobs or cpu_count())
+    runs = pool.imap(run, zip(contexts, results))
+    statuses = []
+    for line, ctx, result, (evaluated, errors), run in zip(lines, contexts, results, outputs, runs):
+        write_labelled(sys.stdout, line, evaluated)
+        write_labelled(sys.stderr, line, errors)
+        if result != 'allowed':
+            statuses.append(2)
+            continue
+        exitCode, stdout, stderr, duration = run or (0, '', '', 0)
+        write_labelled(sys.stdout, line, stdout)
+        write_labelled(sys.stderr, line, stderr)
+        finish(ctx, exitCode, duration)
+        # killed by a signal: report it the way a shell would
+        statuses.append(128 - exitCode if exitCode < 0 else exitCode)
+    pool.close()
+    after([ctx for ctx, result in zip(contexts, results) if result == 'allowed'])
+    return max(statuses or [0])
+
+if args.fan_out:
+    if args.fan_out == '-':
+        exit_with(fan_out(sys.stdin))
+    try:
+        source = open(args.fan_out)
+    except IOError as e:
+        eprint('Could not read fan-out file:', str(e))
+        exit_with(2)
+    with source:
+        exit_with(fan_out(source))
+
+def nested_clictl(cmds):
+    # the arguments given to clictl when cmds runs this same script, directly
+    # or through a python interpreter; None otherwise
+    argv = cmds[1:] if len(cmds) > 1 and re.match(r'^python[0-9.]*$', os.path.basename(cmds[0])) else cmds
+    if len(argv) == 0:
+        return None
+    executable = argv[0] if os.sep in argv[0] else find_executable(argv[0])
+    if executable and os.path.realpath(executable) == os.path.realpath(__file__):
+        return argv[1:]
+    return None
+
+def nested_layer(options, cmds):
+    # (options, cmds, config) of a clictl wrapped by this layer that can be
+    # evaluated in this process instead of being spawned, else None
+    nested = nested_clictl(cmds) if not options.no_collapse else None
+    if nested is None:
+        return None
+    clictl_args, other_args = split_args(nested)
+    # only a probe: usage errors and --help are left for the spawned clictl to print
+    from StringIO import StringIO
+    streams = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        inner = parser.parse_args(clictl_args)
+    except SystemExit:
+        return None
+    finally:
+        sys.stdout, sys.stderr = streams
+    if any(getattr(inner, o) != getattr(options, o) for o in PROCESS_OPTIONS):
+        return None
+    return inner, other_args
+
+# wrappers around wrappers are evaluated outermost first in this process and
+# only the innermost target is spawned; after steps unwind innermost first
+contexts = []
+layer = (cmds, args, config)
+exitCode = None
+while layer:
+    ctx = make_context(*layer)
+    if evaluate(ctx) != 'allowed':
+        exitCode = 2
+        break
+    contexts.append(ctx)
+    nested = nested_layer(ctx.options, ctx.cmds)
+    layer = None
+    if nested:
+        inner, inner_cmds = nested
+        inner_config = load_config(inner)
+        if inner_config is None:
+            exitCode = 2
+            break
+        layer = (inner_cmds, inner, inner_config)
+
+# a cache hit replays the recorded output without spawning or taking limits
+cached = [c.cache for c in contexts if c.cache]
+cache_spec = cached[-1] if exitCode is None and cached and len(ctx.cmds) > 0 else None
+if cache_spec:
+    cache_key = ResultCache.key(ctx.cmds, cache_spec)
+    hit = cache.get(cache_key, cache_spec['ttl'])
+    if hit:
+        exitCode, stdout, stderr = hit
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        sys.stdout.flush()
+        try:
+            cache.hit(cache_key, len(stdout) + len(stderr))
+        except (IOError, OSError) as e:
+            eprint('Could not update result cache:', str(e))
+        if metrics:
+            metrics.inc('clictl_cache_hits_total')
+            metrics.inc('clictl_cache_bytes_saved_total', None, len(stdout) + len(stderr))
+        # nothing ran, so keep the replay out of the child runtime histogram
+        for c in contexts:
+            finish(c, exitCode, 0, False)
+        after(list(reversed(contexts)))
+        exit_with(exitCode)
+    try:
+        cache.miss()
+    except (IOError, OSError) as e:
+        eprint('Could not use result cache, running uncached:', str(e))
+        cache_spec = None
+    if metrics:
+        metrics.inc('clictl_cache_misses_total')
+
+held = []
+if exitCode is None and len(ctx.cmds) > 0:
+    try:
+        held = limiter.acquire_all([l for c in contexts for l in c.limits])
+    except (Limiter.Timeout, IOError, OSError) as e:
+        eprint('Limit not acquired:', str(e))
+        exitCode = 2
 
+started = time.time()
+if exitCode is None:
+    exitCode = 0
+    if cache_spec:
+        exitCode, stdout, stderr = run_teed(ctx.cmds)
+        if exitCode in cache_spec['codes']:
+            try:
+                cache.put(cache_key, exitCode, stdout, stderr)
+            except (IOError, OSError) as e:
+                eprint('Could not update result cache:', str(e))
+    elif len(ctx.cmds) > 0:
+        p = subprocess.Popen(ctx.cmds, bufsize=4029, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+        p.communicate()
+        exitCode = p.wait()
+Limiter.release(held)
+for c in contexts:
+    finish(c, exitCode, time.time() - started)
 
-if len(cmds) > 0:
-    p = subprocess.Popen(cmds, bufsize=4029, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
-    p.communicate()
-    exitCode = p.wait()
-    sys.exit(exitCode)
+after(list(reversed(contexts)))
+exit_with(exitCode)
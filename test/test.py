@@ -2,6 +2,10 @@ import unittest
 import subprocess
 import tempfile
 import os
+import json
+import time
+import socket
+import getpass
 
 this_file_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -13,13 +17,14 @@ class TestStringMethods(unittest.TestCase):
         args = kwargs.get('args', [])
         env = kwargs.get('env', None)
         stdin = kwargs.get('stdin', None)
+        stderr = subprocess.STDOUT if kwargs.get('stderr', False) else None
         configfile = tempfile.mkstemp()[1]
         with open(configfile, 'w') as f:
             f.write(config)
         cmds = ['python', this_file_dir + '/../src/clictl.py', '--config-file', configfile] + args
         print(cmds)
         try:
-            p = subprocess.Popen(" ".join(cmds), env = env, shell = True, stdin = subprocess.PIPE if stdin is not None else None, stdout = subprocess.PIPE)
+            p = subprocess.Popen(" ".join(cmds), env = env, shell = True, stdin = subprocess.PIPE if stdin is not None else None, stdout = subprocess.PIPE, stderr = stderr)
             stdout, _ = p.communicate(stdin)
             return p.wait(),stdout.strip()
         except subprocess.CalledProcessError as e:
@@ -506,5 +511,455 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual('bar', out)
         self.assertEqual(0, code)
 
+    def test_metrics_file(self):
+        metricsfile = tempfile.mkstemp()[1]
+        config = """
+            pipeline:
+                - require:
+                    match:
+                        '^true$': '{0}'
+        """
+        for cmd in ['true', 'true', 'false']:
+            self.run_with_config(
+                config = config,
+                args = ['--metrics-file', metricsfile, '--metrics-interval', '0', '--', cmd]
+            )
+        with open(metricsfile) as f:
+            metrics = f.read()
+        self.assertIn('clictl_invocations_total{result="allowed"} 2\n', metrics)
+        self.assertIn('clictl_invocations_total{result="denied"} 1\n', metrics)
+        self.assertIn('clictl_rule_hits_total{rule="require ({0} match /^true$/)"} 3\n', metrics)
+        self.assertIn('clictl_requirement_not_met_total{rule="require ({0} match /^true$/)"} 1\n', metrics)
+        self.assertIn('clictl_evaluation_seconds_count 3\n', metrics)
+        self.assertIn('clictl_child_seconds_count 2\n', metrics)
+
+    def test_after(self):
+        code, out = self.run_with_config(
+            config = """
+                pipeline:
+                    - echo: before
+                after:
+                    - echo: "after {result.code}"
+            """,
+            args = ['--', 'sh', '-c', "'echo run; exit 3'"]
+        )
+        self.assertEqual('before\nrun\nafter 3', out)
+        self.assertEqual(3, code)
+
+    def test_after_detached(self):
+        markerfile = tempfile.mkstemp()[1]
+        os.remove(markerfile)
+        code, out = self.run_with_config(
+            config = """
+                detach_after: true
+                after:
+                    - shell: "sleep 1; touch {}"
+            """.format(markerfile),
+            args = ['--', 'echo', 'run']
+        )
+        self.assertEqual('run', out)
+        self.assertEqual(0, code)
+        self.assertFalse(os.path.exists(markerfile))
+        for _ in range(50):
+            if os.path.exists(markerfile):
+                break
+            time.sleep(0.1)
+        self.assertTrue(os.path.exists(markerfile))
+
+    def test_profile_reorder(self):
+        profilefile = tempfile.mkstemp()[1]
+        os.remove(profilefile)
+        config = """
+            pipeline:
+                - require:
+                    or:
+                        - match: {'^x': '{1}'}
+                        - match: {'^y': '{1}'}
+                - echo: checked
+                - require:
+                    and:
+                        - not: {match: {'^-A$': '{2}'}}
+                        - match: {'^echo$': '{0}'}
+                - require:
+                    not: {equal: ['{2}', 'z']}
+        """
+        inputs = [['y', 'a'], ['y', 'b'], ['y', '-A'], ['x', 'z'], ['w', 'a']]
+        for i in inputs:
+            self.run_with_config(
+                config = config,
+                args = ['--profile-file', profilefile, '--', 'echo'] + i
+            )
+        with open(profilefile) as f:
+            profile = json.load(f)
+        self.assertEqual(5, profile['{1} match /^x/']['count'])
+        self.assertEqual(1, profile['{1} match /^x/']['true'])
+        self.assertEqual(4, profile['{1} match /^y/']['count'])
+
+        # moving {0} ahead of {1} must not skip the IndexError of a short argv
+        os.remove(profilefile)
+        config = """
+            pipeline:
+                - require:
+                    or:
+                        - match: {'^a': '{1}'}
+                        - match: {'^echo$': '{0}'}
+        """
+        for _ in range(3):
+            self.run_with_config(config = config, args = ['--profile-file', profilefile, '--', 'echo', 'b'])
+        expected = self.run_with_config(config = config, args = ['--', 'echo'])
+        actual = self.run_with_config(config = config, args = ['--reorder-from', profilefile, '--', 'echo'])
+        self.assertEqual(2, expected[0])
+        self.assertEqual(expected, actual)
+
+        # schema flags always resolve, so the check that usually denies moves first
+        os.remove(profilefile)
+        config = """
+            schema:
+                flags:
+                    namespace: {arity: 1, aliases: [-n]}
+                    all-namespaces: {aliases: [-A]}
+            pipeline:
+                - require: {neq: ['{flags.namespace}', 'kube-system']}
+                - require: {not: {equal: ['{flags.all-namespaces}', 'True']}}
+        """
+        inputs = [['-A'], ['-A'], ['-n', 'a', '-A'], ['-n', 'kube-system'], ['-n', 'a']]
+        for i in inputs:
+            self.run_with_config(config = config, args = ['--profile-file', profilefile, '--', 'echo'] + i)
+        for i in inputs:
+            expected = self.run_with_config(config = config, args = ['--', 'echo'] + i)
+            actual = self.run_with_config(config = config, args = ['--reorder-from', profilefile, '--', 'echo'] + i)
+            self.assertEqual(expected, actual)
+        code, out = self.run_with_config(config = config, args = ['--verbose', '--reorder-from', profilefile, '--', 'echo', '-n', 'a'], stderr = True)
+        requires = [line for line in out.splitlines() if ' require (' in line]
+        self.assertEqual(0, code)
+        self.assertIn('all-namespaces', requires[0])
+        self.assertIn('{flags.namespace}', requires[1])
+
+        os.remove(profilefile)
+        config = """
+            pipeline:
+                - require:
+                    or:
+                        - any: {match: '^x$'}
+                        - any: {match: '^y$'}
+                - require:
+                    and:
+                        - not: {any: {match: '^-A$'}}
+                        - count: {match: '.', min: 2}
+        """
+        inputs = [['y', 'a'], ['y', 'b'], ['y', '-A'], ['x', 'z'], ['w']]
+        for i in inputs:
+            self.run_with_config(config = config, args = ['--profile-file', profilefile, '--', 'echo'] + i)
+        for i in inputs + [['x'], ['-A', 'y'], []]:
+            expected = self.run_with_config(config = config, args = ['--', 'echo'] + i)
+            actual = self.run_with_config(config = config, args = ['--reorder-from', profilefile, '--', 'echo'] + i)
+            self.assertEqual(expected, actual)
+        code, out = self.run_with_config(config = config, args = ['--verbose', '--reorder-from', profilefile, '--', 'echo', 'y', 'a'], stderr = True)
+        anys = [line for line in out.splitlines() if ' any ({1..} match /^x$/)' in line or ' any ({1..} match /^y$/)' in line]
+        self.assertEqual(0, code)
+        self.assertIn('/^y$/', anys[0])
+
+    def test_fan_out(self):
+        code, out = self.run_with_config(
+            config = """
+                pipeline:
+                    - require:
+                        not:
+                            match:
+                                '^-A$': '{1}'
+                after:
+                    - echo: "done {1} {result.code}"
+            """,
+            args = ['--fan-out', '-', '--jobs', '2', '--', 'echo'],
+            stdin = 'ns1\n-A\n"ns 2"\n'
+        )
+        self.assertEqual('[ns1] ns1\n["ns 2"] ns 2\ndone ns1 0\ndone ns 2 0', out)
+        self.assertEqual(2, code)
+
+        code, out = self.run_with_config(
+            args = ['--fan-out', '-', '--', 'sh', '-c'],
+            stdin = '"exit 0"\n"exit 3"\n"exit 1"\n'
+        )
+        self.assertEqual(3, code)
+
+        code, out = self.run_with_config(
+            args = ['--fan-out', '-', '--', 'sh', '-c'],
+            stdin = '"exit 0"\n"kill -9 $$"\n'
+        )
+        self.assertEqual(137, code)
+
+        code, out = self.run_with_config(
+            args = ['--fan-out', '-', '--', 'echo'],
+            stdin = 'ok\n"unclosed\n'
+        )
+        self.assertEqual((2, '[ok] ok'), (code, out))
+
+        code, out = self.run_with_config(args = ['--fan-out', '-', '--jobs', '0', '--', 'echo'], stdin = 'ok\n')
+        self.assertEqual((2, ''), (code, out))
+
+        # evaluation output is labelled and kept with its item
+        code, out = self.run_with_config(
+            config = """
+                pipeline:
+                    - echo: 'checking {1}'
+                    - require: {neq: ['{1}', '-A']}
+            """,
+            args = ['--fan-out', '-', '--', 'echo'],
+            stdin = 'a\n-A\n',
+            stderr = True
+        )
+        self.assertEqual(2, code)
+        self.assertEqual(['[a] checking a', '[a] a', '[-A] checking -A', '[-A] Requirement not met: require (not (({1} == -A)))'],
+            [line for line in out.splitlines() if line.startswith('[')])
+
+        code, out = self.run_with_config(args = ['--fan-out', '/nonexistent/items', '--', 'echo'], stderr = True)
+        self.assertEqual(2, code)
+        self.assertIn('Could not read fan-out file', out)
+
+    def test_any_all_count(self):
+        config = """
+            pipeline:
+                - require:
+                    not:
+                        any:
+                            match: '^(--all-namespaces|-A)$'
+                - require:
+                    count:
+                        eq: '-v'
+                        max: 1
+                - echo: ok
+        """
+        code, out = self.run_with_config(config = config, args = ['--', 'true', 'get', '-v'])
+        self.assertEqual((0, 'ok'), (code, out))
+        code, out = self.run_with_config(config = config, args = ['--', 'true', 'get', '-A'])
+        self.assertEqual(2, code)
+        code, out = self.run_with_config(config = config, args = ['--', 'true', '-v', 'get', '-v'])
+        self.assertEqual(2, code)
+
+        config = """
+            pipeline:
+                - require:
+                    all:
+                        match: '^\\./deploy/'
+                - require:
+                    count:
+                        match: 'yaml$'
+                        min: 1000
+        """
+        files = ['./deploy/{}.yaml'.format(i) for i in range(1000)]
+        code, out = self.run_with_config(config = config, args = ['--', 'true'] + files)
+        self.assertEqual(0, code)
+        code, out = self.run_with_config(config = config, args = ['--', 'true'] + files + ['./etc/passwd'])
+        self.assertEqual(2, code)
+        code, out = self.run_with_config(config = config, args = ['--', 'true'] + files[1:])
+        self.assertEqual(2, code)
+
+        for predicate in ["count: {match: 'x', min: '2'}", "count: {match: 'x', max: true}", "count: {match: 'x', min: 3, max: 2}", "any: '^-A$'"]:
+            code, out = self.run_with_config(config = '[{require: {' + predicate + '}}, {echo: ok}]', args = ['--', 'true', 'x'], stderr = True)
+            self.assertEqual(2, code)
+            self.assertIn('Invalid configuration', out)
+
+    def test_schema(self):
+        config = """
+            schema:
+                flags:
+                    namespace:
+                        arity: 1
+                        aliases: [-n]
+                    all-namespaces:
+                        aliases: [-A]
+                subcommands:
+                    get:
+                        flags:
+                            output: {arity: 1, aliases: [-o]}
+            pipeline:
+                - require:
+                    not:
+                        equal: ['{flags.all-namespaces}', 'True']
+                - echo: '{subcommand} {flags.namespace} {flags.output} {positionals[0]}'
+        """
+        for args in [['get', '-n', 'prod', 'pods'], ['get', '--namespace=prod', 'pods'], ['--namespace', 'prod', 'get', 'pods'], ['get', '-nprod', 'pods']]:
+            code, out = self.run_with_config(config = config, args = ['--', 'true'] + args)
+            self.assertEqual('get prod  pods', out)
+        code, out = self.run_with_config(config = config, args = ['--', 'true', 'get', '-oyaml', 'pods', '-n', 'dev'])
+        self.assertEqual('get dev yaml pods', out)
+        code, out = self.run_with_config(config = config, args = ['--', 'true', 'get', 'pods', '-A'])
+        self.assertEqual(2, code)
+        code, out = self.run_with_config(config = config, args = ['--', 'true', 'get', 'pods', '-n'])
+        self.assertEqual((0, 'get   pods'), (code, out))
+
+        code, out = self.run_with_config(
+            config = """
+                schema:
+                    flags:
+                        namespace: -n
+                pipeline:
+                    - echo: ok
+            """,
+            args = ['--', 'true']
+        )
+        self.assertEqual((2, ''), (code, out))
+
+    def test_facts(self):
+        kubeconfig = tempfile.mkstemp()[1]
+        with open(kubeconfig, 'w') as f:
+            f.write("""
+                current-context: prod
+                contexts:
+                    - name: prod
+                      context: {namespace: payments}
+            """)
+        factscache = tempfile.mkstemp()[1]
+        os.remove(factscache)
+        for _ in range(2):
+            code, out = self.run_with_config(
+                config = """
+                    - echo: '{facts.host.name} {facts.user.name} {facts.kube.context} {facts.kube.namespace}'
+                """,
+                args = ['--facts-cache', factscache],
+                env = dict(os.environ, KUBECONFIG = kubeconfig)
+            )
+            self.assertEqual((0, '{} {} prod payments'.format(socket.gethostname(), getpass.getuser())), (code, out))
+        with open(factscache) as f:
+            self.assertEqual('prod', json.load(f)['kubeconfig:' + kubeconfig]['value']['current-context'])
+
+        # entries are merged first-wins across KUBECONFIG, as kubectl does
+        first = tempfile.mkstemp()[1]
+        with open(first, 'w') as f:
+            f.write('current-context: prod\n')
+        code, out = self.run_with_config(
+            config = """
+                - echo: '{facts.kube.context} {facts.kube.namespace}'
+            """,
+            args = ['--facts-cache', factscache],
+            env = dict(os.environ, KUBECONFIG = first + ':' + kubeconfig)
+        )
+        self.assertEqual((0, 'prod payments'), (code, out))
+
+    def test_nested_collapse(self):
+        innerconfig = tempfile.mkstemp()[1]
+        with open(innerconfig, 'w') as f:
+            f.write("""
+                pipeline:
+                    - echo: 'inner {0} {1}'
+                    - require:
+                        neq: ['{1}', 'bad']
+                after:
+                    - echo: 'inner after {result.code}'
+            """)
+        config = """
+            pipeline:
+                - echo: 'outer {0}'
+                - assign:
+                    pid:
+                        shell: 'echo $PPID'
+                - echo: '{usr.pid}'
+            after:
+                - echo: 'outer after {result.code}'
+        """
+        inner = ['--', 'python', this_file_dir + '/../src/clictl.py', '--config-file', innerconfig, '--']
+        code, out = self.run_with_config(config = config, args = inner + ['sh', '-c', "'echo $PPID'", 'ok'])
+        lines = out.split('\n')
+        self.assertEqual(['outer python', 'inner sh -c', 'inner after 0', 'outer after 0'], lines[:1] + lines[2:3] + lines[4:])
+        self.assertEqual(lines[1], lines[3])
+        self.assertEqual(0, code)
+
+        code, out = self.run_with_config(config = config, args = inner + ['echo', 'bad'])
+        self.assertEqual(2, code)
+        self.assertTrue(out.endswith('inner echo bad\nouter after 2'))
+
+        # --cache-stats has no target, so the inner clictl must run to print it
+        cachedir = tempfile.mkdtemp()
+        clictl = ['python', this_file_dir + '/../src/clictl.py', '--cache-dir', cachedir]
+        code, out = self.run_with_config(args = ['--cache-dir', cachedir, '--'] + clictl + ['--cache-stats'])
+        self.assertEqual((0, 0), (code, json.loads(out)['hits']))
+
+        # an inner usage error is reported once, by the spawned clictl
+        code, out = self.run_with_config(args = ['--'] + clictl + ['--bogus'], stderr = True)
+        self.assertEqual(2, code)
+        self.assertEqual(1, out.count('unrecognized arguments: --bogus'))
+
+    def test_limit(self):
+        lockdir = tempfile.mkdtemp()
+        config = """
+            pipeline:
+                - limit:
+                    name: '{0}-test'
+                    max: 1
+                    timeout: 0.5
+        """
+        configfile = tempfile.mkstemp()[1]
+        with open(configfile, 'w') as f:
+            f.write(config)
+        holder = subprocess.Popen(['python', this_file_dir + '/../src/clictl.py', '--config-file', configfile, '--lock-dir', lockdir, '--', 'sleep', '5'])
+        try:
+            for _ in range(50):
+                if os.path.exists(os.path.join(lockdir, 'sleep-test.0.lock')):
+                    break
+                time.sleep(0.1)
+            code, out = self.run_with_config(config = config, args = ['--lock-dir', lockdir, '--', 'sleep', '0'])
+            self.assertEqual(2, code)
+        finally:
+            holder.kill()
+            holder.wait()
+        code, out = self.run_with_config(config = config, args = ['--lock-dir', lockdir, '--', 'sleep', '0'])
+        self.assertEqual(0, code)
+
+        # collapsed layers sharing a limit name take a single slot
+        innerconfig = tempfile.mkstemp()[1]
+        with open(innerconfig, 'w') as f:
+            f.write(config.replace('{0}', 'sleep').replace('0.5', '1'))
+        code, out = self.run_with_config(config = config.replace('{0}', 'sleep'), args = ['--lock-dir', lockdir, '--', 'python', this_file_dir + '/../src/clictl.py', '--config-file', innerconfig, '--lock-dir', lockdir, '--', 'echo', 'ok'])
+        self.assertEqual((0, 'ok'), (code, out))
+
+        code, out = self.run_with_config(config = config.replace('0.5', 'soon'), args = ['--lock-dir', lockdir, '--', 'echo', 'ok'])
+        self.assertEqual((2, ''), (code, out))
+
+    def test_result_cache(self):
+        cachedir = tempfile.mkdtemp()
+        config = """
+            pipeline:
+                - cache:
+                    ttl: 60
+        """
+        command = ['--cache-dir', cachedir, '--', 'sh', '-c', "'echo $$'"]
+        code, first = self.run_with_config(config = config, args = command)
+        code, second = self.run_with_config(config = config, args = command)
+        self.assertEqual(first, second)
+        code, third = self.run_with_config(config = config.replace('60', '0'), args = command)
+        self.assertNotEqual(first, third)
+
+        code, out = self.run_with_config(config = config, args = ['--cache-dir', cachedir, '--', 'sh', '-c', "'exit 3'"])
+        code, out = self.run_with_config(config = config, args = ['--cache-dir', cachedir, '--', 'sh', '-c', "'exit 3'"])
+        self.assertEqual(3, code)
+
+        code, out = self.run_with_config(args = ['--cache-dir', cachedir, '--cache-stats'])
+        stats = json.loads(out)
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+        self.assertEqual(len(first) + 1, stats['bytes_saved'])
+
+        cachedir = tempfile.mkdtemp()
+        for word in ['aaaa', 'bbbb', 'aaaa', 'cccc', 'aaaa']:
+            self.run_with_config(config = config, args = ['--cache-dir', cachedir, '--cache-size', '10', '--', 'echo', word])
+        code, out = self.run_with_config(args = ['--cache-dir', cachedir, '--cache-stats'])
+        stats = json.loads(out)
+        self.assertEqual(2, stats['entries'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(10, stats['bytes'])
+
+        code, out = self.run_with_config(config = config, args = ['--cache-dir', '/etc/passwd/x', '--', 'sh', '-c', "'echo ok; exit 3'"])
+        self.assertEqual((3, 'ok'), (code, out))
+
+        # arguments need not be utf-8, and replays do not count as child runs
+        metricsfile = tempfile.mkstemp()[1]
+        for _ in range(2):
+            code, out = self.run_with_config(config = config, args = ['--cache-dir', cachedir, '--metrics-file', metricsfile, '--metrics-interval', '0', '--', 'echo', '\xff'])
+            self.assertEqual((0, '\xff'), (code, out))
+        with open(metricsfile) as f:
+            metrics = f.read()
+        self.assertIn('clictl_cache_hits_total 1\n', metrics)
+        self.assertIn('clictl_child_seconds_count 1\n', metrics)
+
 if __name__ == '__main__':
     unittest.main()